@@ -14,7 +14,7 @@ import torch
 from torch import Tensor, nn
 from torch.nn import functional as F
 
-from .utils import _irfft, _rfft, _svd, fftfreq
+from .utils import _irfft, _rfft, _solve_triangular, _svd, fftfreq
 
 
 def _zero_mean(input: Tensor,
@@ -58,9 +58,9 @@ def cca_by_svd(x: Tensor,
     u_2, s_2, v_2 = _svd(y)
     uu = u_1.t() @ u_2
     u, diag, v = _svd(uu)
-    # v @ s.diag() = v * s.view(-1, 1), but much faster
-    a = (v_1 * s_1.reciprocal_().unsqueeze_(0)) @ u
-    b = (v_2 * s_2.reciprocal_().unsqueeze_(0)) @ v
+    # v @ s.diag().inverse() @ u = v @ (u / s.view(-1, 1)), scaling the DxC factor instead of the DxD one
+    a = v_1 @ (u / s_1.unsqueeze(1))
+    b = v_2 @ (v / s_2.unsqueeze(1))
     return a, b, diag
 
 
@@ -82,8 +82,8 @@ def cca_by_qr(x: Tensor,
     q_2, r_2 = torch.linalg.qr(y)
     qq = q_1.t() @ q_2
     u, diag, v = _svd(qq)
-    a = r_1.inverse() @ u
-    b = r_2.inverse() @ v
+    a = _solve_triangular(r_1, u)
+    b = _solve_triangular(r_2, v)
     return a, b, diag
 
 
@@ -176,7 +176,7 @@ def pwcca_distance(x: Tensor,
     a, b, diag = cca(x, y, backend)
     alpha = (x @ a).abs_().sum(dim=0)
     alpha /= alpha.sum()
-    return 1 - alpha @ diag
+    return 1 - (alpha * diag).sum()
 
 
 def _debiased_dot_product_similarity(z: Tensor,
@@ -217,8 +217,8 @@ def linear_cka_distance(x: Tensor,
     if reduce_bias:
         size = x.size(0)
         # (x @ x.t()).diag()
-        sum_row_x = torch.einsum('ij,ij->i', x, x)
-        sum_row_y = torch.einsum('ij,ij->i', y, y)
+        sum_row_x = x.square().sum(dim=1)
+        sum_row_y = y.square().sum(dim=1)
         sq_norm_x = sum_row_x.sum()
         sq_norm_y = sum_row_y.sum()
         dot_prod = _debiased_dot_product_similarity(dot_prod, sum_row_x, sum_row_y, sq_norm_x, sq_norm_y, size)
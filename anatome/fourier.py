@@ -1,3 +1,5 @@
+import math
+from functools import lru_cache
 from typing import Callable, List, Optional, Tuple
 
 import torch
@@ -5,7 +7,72 @@ from torch import Tensor, nn
 from torch.nn import functional as F
 from tqdm import tqdm
 
-from .utils import _denormalize, _evaluate, _normalize, ifft_shift, _irfft
+from .utils import _compile, _denormalize, _evaluate_batch, _normalize
+
+
+@lru_cache(maxsize=8)
+def _sinusoid_table(n: int,
+                    dtype: torch.dtype,
+                    device: torch.device
+                    ) -> Tuple[Tensor, Tensor]:
+    # cos(2 pi f t / n) and sin(2 pi f t / n) of NxN, indexed by frequency f and time t
+    # cached, as fourier_map calls _fourier_noise_batch for every chunk with the same size
+    t = torch.arange(n, device=device)
+    # reduce f * t modulo n before scaling to keep the angles precise
+    angle = (torch.outer(t, t) % n).to(dtype) * (2 * math.pi / n)
+    return angle.cos(), angle.sin()
+
+
+def _fourier_noise_batch(idx: Tensor,
+                         images: Tensor,
+                         norm: float,
+                         size: Optional[Tuple[int, int]] = None,
+                         ) -> Tuple[Tensor, Tensor]:
+    """ Build a batch of Fourier noise, one basis per index
+
+    Args:
+        idx: indices to be used, Kx2
+        images: original images, used for size, dtype and device
+        norm: norm of additive noise
+        size: size of the Fourier basis, (H, W). If given, noise is interpolated to the size of images.
+
+    Returns: Fourier bases of Kx1xHxW and their scales of Kx1x1x1 so that the norm of noise is `norm`.
+    The scale is applied when the noise is added to images.
+
+    """
+
+    if size is None:
+        _, _, h, w = images.size()
+    else:
+        h, w = size
+
+    idx = idx.to(images.device)
+    # the pair of deltas in the shifted spectrum, Kx2 each, moved to unshifted frequencies by rolling (n + 1) // 2
+    rows = (torch.stack([idx[:, 0], h - 1 - idx[:, 0]], dim=1) - (h + 1) // 2) % h
+    cols = (torch.stack([idx[:, 1], w - 1 - idx[:, 1]], dim=1) - (w + 1) // 2) % w
+    # the spectrum has only two nonzeros of 1+1j, so its iFFT is a sum of two sinusoids,
+    # Re((1+1j) exp(i(a+b))) = cos(a+b) - sin(a+b) = (cos a - sin a) cos b - (cos a + sin a) sin b,
+    # which is computed from tables of 1D sinusoids, without FFT. The constant of iFFT cancels in the normalization.
+    cos_h, sin_h = _sinusoid_table(h, images.dtype, images.device)
+    cos_w, sin_w = _sinusoid_table(w, images.dtype, images.device)
+    # Kx4xH and Kx4xW
+    left = torch.cat([cos_h[rows] - sin_h[rows], -(cos_h[rows] + sin_h[rows])], dim=1)
+    right = torch.cat([cos_w[cols], sin_w[cols]], dim=1)
+    # a single batched matmul over K
+    recon = (left.transpose(1, 2) @ right).unsqueeze(1)
+    scale = norm / recon.flatten(1).norm(p=2, dim=1).view(-1, 1, 1, 1)
+    if size is not None:
+        recon = F.interpolate(recon, images.shape[2:])
+    return recon, scale
+
+
+@_compile
+def _add_and_clamp(images: Tensor,
+                   recon: Tensor,
+                   scale: Tensor
+                   ) -> Tensor:
+    # images + recon * scale in [0, 1], fused into a single kernel when compiled
+    return torch.clamp(images + recon * scale, 0, 1)
 
 
 def add_fourier_noise(idx: Tuple[int, int],
@@ -25,22 +92,8 @@ def add_fourier_noise(idx: Tuple[int, int],
 
     """
 
-    images = images.clone()
-
-    if size is None:
-        _, _, h, w = images.size()
-    else:
-        h, w = size
-
-    noise = images.new_zeros(1, h, w, 2)
-    noise[:, idx[0], idx[1]] = 1
-    noise[:, h - 1 - idx[0], w - 1 - idx[1]] = 1
-    recon = _irfft(ifft_shift(noise), 2, normalized=True, onesided=False).unsqueeze(0)
-    recon.div_(recon.norm(p=2)).mul_(norm)
-    if size is not None:
-        recon = F.interpolate(recon, images.shape[2:])
-    images.add_(recon).clamp_(0, 1)
-    return images
+    recon, scale = _fourier_noise_batch(torch.as_tensor(idx).view(1, 2), images, norm, size)
+    return _add_and_clamp(images, recon, scale)
 
 
 @torch.no_grad()
@@ -50,7 +103,8 @@ def fourier_map(model: nn.Module,
                 norm: float,
                 fourier_map_size: Optional[Tuple[int, int]] = None,
                 mean: Optional[List[float] or Tensor] = None,
-                std: Optional[List[float] or Tensor] = None
+                std: Optional[List[float] or Tensor] = None,
+                chunk_size: int = 1
                 ) -> Tensor:
     """
 
@@ -62,6 +116,8 @@ def fourier_map(model: nn.Module,
         fourier_map_size: Size of map, (H, W). Note that the computational time is dominated by HW.
         mean: If the range of input is [-1, 1], specify mean and std.
         std: If the range of input is [-1, 1], specify mean and std.
+        chunk_size: Number of Fourier bases evaluated in a single forward pass. Note that the model sees
+            chunk_size x B images at once, so memory usage grows linearly with it.
 
     Returns:
 
@@ -75,13 +131,19 @@ def fourier_map(model: nn.Module,
         _mean = torch.as_tensor(mean, device=input.device, dtype=torch.float)
         _std = torch.as_tensor(std, device=input.device, dtype=torch.float)
         input = _denormalize(input, _mean, _std)  # [0, 1]
-    map = torch.zeros(h, w)
-    for u_i in tqdm(torch.triu_indices(h, w).t(), ncols=80):
-        l_i = h - 1 - u_i[0], w - 1 - u_i[1]
-        noisy_input = add_fourier_noise(u_i, input, norm, fourier_map_size)
+    # 2xK, kept on device
+    idx = torch.triu_indices(h, w, device=input.device)
+    losses = []
+    for idx_i in tqdm(idx.t().split(chunk_size), ncols=80):
+        # only chunk_size bases of kx1xHxW are alive at once
+        recon_i, scale_i = _fourier_noise_batch(idx_i, input, norm, fourier_map_size)
+        # kx1x1xHxW + BxCxHxW -> kxBxCxHxW
+        noisy_input = _add_and_clamp(input, recon_i.unsqueeze(1), scale_i.unsqueeze(1))
         if mean is not None:
             noisy_input = _normalize(noisy_input, _mean, _std)  # to [-1, 1]
-        loss = _evaluate(model, (noisy_input, target), criterion)
-        map[u_i[0], u_i[1]] = loss
-        map[l_i[0], l_i[1]] = loss
-    return map
+        losses.append(_evaluate_batch(model, (noisy_input, target), criterion))
+    losses = torch.cat(losses).float()
+    map = losses.new_zeros(h, w)
+    map.index_put_((idx[0], idx[1]), losses)
+    map.index_put_((h - 1 - idx[0], w - 1 - idx[1]), losses)
+    return map.cpu()
@@ -11,7 +11,7 @@ from torch import Tensor, nn
 from torch.nn import functional as F
 
 import uutils.torch_uu
-from anatome.utils import _irfft, _rfft, _svd, fftfreq
+from anatome.utils import _compile, _solve_triangular, _svd
 
 # - safe value for N' = s*D' according to svcca paper and our santiy checks to get trust worthy CCA sims.
 from uutils import torch_uu
@@ -20,6 +20,22 @@ from uutils import torch_uu
 from pdb import set_trace as st
 
 SAFTEY_VAL: int = 10
+# - opt-in randomized SVD for _svd_reduction, see use_lowrank_svd
+LOWRANK_SVD: bool = False
+# - number of components computed by the randomized SVD of _svd_reduction, used when min(N, D) is larger than it
+LOWRANK_SVD_Q: int = 128
+# - number of matrices batched by each torch.vmap call of _distances_per_matrix, which bounds the memory it needs
+VMAP_CHUNK_SIZE: int = 32
+
+
+def use_lowrank_svd() -> None:
+    """ Try a randomized SVD of LOWRANK_SVD_Q components first in the SV reduction of SVCCA.
+    It is only faster for steeply decaying spectra, where 0.99 of the variance is provably kept by the top components,
+    otherwise it falls back to the full SVD after having paid for the randomized one. Its result also depends on the
+    global RNG state.
+    """
+    global LOWRANK_SVD
+    LOWRANK_SVD = True
 
 
 def _check_shape_equal(x: Tensor,
@@ -36,6 +52,7 @@ def _zero_mean(input: Tensor,
     return input - input.mean(dim=dim, keepdim=True)
 
 
+@_compile
 def _matrix_normalize(input: Tensor,
                       dim: int
                       ) -> Tensor:
@@ -50,9 +67,9 @@ def _matrix_normalize(input: Tensor,
     :param dim:
     :return:
     """
-    from torch.linalg import norm
     X_centered: Tensor = _zero_mean(input, dim=dim)
-    X_star: Tensor = X_centered / norm(X_centered, "fro")
+    # single-pass norm without an input-sized temporary, out of place since vector_norm saves X_centered for backward
+    X_star: Tensor = X_centered / torch.linalg.vector_norm(X_centered)
     return X_star
 
 
@@ -95,9 +112,9 @@ def _cca_by_svd(x: Tensor,
     uu = u_1.t() @ u_2
     # - see page 4 for correctness of this step
     u, diag, v = _svd(uu)
-    # v @ s.diag() = v * s.view(-1, 1), but much faster
-    a = (v_1 * s_1.reciprocal_().unsqueeze_(0)) @ u
-    b = (v_2 * s_2.reciprocal_().unsqueeze_(0)) @ v
+    # v @ s.diag().inverse() @ u = v @ (u / s.view(-1, 1)), scaling the DxC factor instead of the DxD one
+    a = v_1 @ (u / s_1.unsqueeze(1))
+    b = v_2 @ (v / s_2.unsqueeze(1))
     return a, b, diag
 
 
@@ -120,25 +137,15 @@ def _cca_by_qr(x: Tensor,
     q_2, r_2 = torch.linalg.qr(y)
     qq = q_1.t() @ q_2
     u, diag, v = _svd(qq)
-    a = r_1.inverse() @ u
-    b = r_2.inverse() @ v
+    a = _solve_triangular(r_1, u)
+    b = _solve_triangular(r_2, v)
     return a, b, diag
 
 
-def cca(x: Tensor,
-        y: Tensor,
-        backend: str
-        ) -> Tuple[Tensor, Tensor, Tensor]:
-    """ Compute CCA, Canonical Correlation Analysis
-
-    Args:
-        x: input tensor of Shape NxD1
-        y: input tensor of Shape NxD2
-        backend: svd or qr
-
-    Returns: x-side coefficients, y-side coefficients, diagonal
-
-    """
+def _check_cca_input(x: Tensor,
+                     y: Tensor,
+                     backend: str
+                     ) -> None:
     assert (x.size(0) == y.size(0)), f'Traditional CCA needs same number of data points for both data matrices' \
                                      f'for it to work but got {x.size(0)=} and {y.size(0)=}'
     if x.size(0) < x.size(1) or y.size(0) < y.size(1):
@@ -159,6 +166,22 @@ def cca(x: Tensor,
     if backend not in ('svd', 'qr'):
         raise ValueError(f'backend is svd or qr, but got {backend}')
 
+
+def cca(x: Tensor,
+        y: Tensor,
+        backend: str
+        ) -> Tuple[Tensor, Tensor, Tensor]:
+    """ Compute CCA, Canonical Correlation Analysis
+
+    Args:
+        x: input tensor of Shape NxD1
+        y: input tensor of Shape NxD2
+        backend: svd or qr
+
+    Returns: x-side coefficients, y-side coefficients, diagonal
+
+    """
+    _check_cca_input(x, y, backend)
     x = _zero_mean(x, dim=0)
     y = _zero_mean(y, dim=0)
     # x = _divide_by_max(_zero_mean(x, dim=0))
@@ -166,6 +189,32 @@ def cca(x: Tensor,
     return _cca_by_svd(x, y) if backend == 'svd' else _cca_by_qr(x, y)
 
 
+def cca_diag(x: Tensor,
+             y: Tensor,
+             backend: str
+             ) -> Tensor:
+    """ Compute only the canonical correlations of CCA, skipping the coefficients.
+    The diagonal is the singular values of Q_1^T Q_2, where Q_i is an orthonormal basis of each centered input, so
+    neither the right singular vectors of the inputs nor those of Q_1^T Q_2 are needed.
+
+    Args:
+        x: input tensor of Shape NxD1
+        y: input tensor of Shape NxD2
+        backend: svd or qr
+
+    Returns: diagonal, same as the one of `cca`
+
+    """
+    _check_cca_input(x, y, backend)
+    x = _zero_mean(x, dim=0)
+    y = _zero_mean(y, dim=0)
+    if backend == 'svd':
+        q_1, q_2 = _svd(x)[0], _svd(y)[0]
+    else:
+        q_1, q_2 = torch.linalg.qr(x)[0], torch.linalg.qr(y)[0]
+    return torch.linalg.svdvals(q_1.t() @ q_2)
+
+
 def _svd_reduction(input: Tensor,
                    accept_rate: float
                    ) -> Tensor:
@@ -181,16 +230,53 @@ def _svd_reduction(input: Tensor,
     :param accept_rate:
     :return:
     """
-    left, diag, right = _svd(input)
+    if LOWRANK_SVD and min(input.size()) > LOWRANK_SVD_Q:
+        reduced: Optional[Tensor] = _svd_reduction_lowrank(input, accept_rate, LOWRANK_SVD_Q)
+        if reduced is not None:
+            return reduced
+    _, diag, right = _svd(input)
     full = diag.abs().sum()
     ratio = diag.abs().cumsum(dim=0) / full
-    num = torch.where(ratio < accept_rate,
-                      input.new_ones(1, dtype=torch.long),
-                      input.new_zeros(1, dtype=torch.long)
-                      ).sum()
+    # ratio is non-decreasing, so the number of components with ratio < accept_rate is found by a binary search
+    num = int(torch.searchsorted(ratio, ratio.new_tensor([accept_rate])))
     return input @ right[:, :num]
 
 
+def _svd_reduction_lowrank(input: Tensor,
+                           accept_rate: float,
+                           q: int
+                           ) -> Optional[Tensor]:
+    """
+    Randomized version of _svd_reduction that only computes the top-q singular values and vectors.
+
+    Note:
+        - the sum of all singular values is unknown, but it's bounded from below by the top-q sum and from above by
+        adding sqrt((r - q) * (||input||_F^2 - sum_i^q s_i^2)) for the r - q remaining ones (Cauchy-Schwarz).
+        If both bounds give the same number of components and it is smaller than q, it is used, otherwise returns
+        None so that the caller falls back to the full SVD.
+        - the top-q singular values and right singular vectors are approximated with 2 power iterations, without
+        touching the global RNG, so the number of components and the reduction are approximately, not exactly, the
+        ones of the full SVD.
+
+    :param input:
+    :param accept_rate:
+    :param q:
+    :return:
+    """
+    with torch.random.fork_rng(devices=[input.device] if input.is_cuda else []):
+        _, diag, right = torch.svd_lowrank(input, q=q, niter=2)
+    r = min(input.size())
+    cumsum = diag.cumsum(dim=0)
+    tail_sq = (input.pow(2).sum() - diag.pow(2).sum()).clamp(min=0)
+    lower = cumsum[-1]
+    upper = lower + (tail_sq * (r - q)).sqrt()
+    num_lower = int(torch.searchsorted(cumsum, (accept_rate * lower).view(1)))
+    num_upper = int(torch.searchsorted(cumsum, (accept_rate * upper).view(1)))
+    if num_lower != num_upper or num_upper >= q:
+        return None
+    return input @ right[:, :num_upper]
+
+
 def _svd_reduction_keeping_fixed_dims(input: Tensor, num: int) -> Tensor:
     """
     Outputs the SV part of SVCCA, removing a fixed number of SVD simensions.
@@ -257,7 +343,8 @@ def svcca_distance(x: Tensor,
     x = _svd_reduction(x, accept_rate)
     y = _svd_reduction(y, accept_rate)
     div = min(x.size(1), y.size(1))
-    a, b, diag = cca(x, y, backend)
+    # only the diagonal is needed, so skip the CCA coefficients
+    diag = cca_diag(x, y, backend)
     return 1 - diag.sum() / div
     # return diag
 
@@ -292,7 +379,7 @@ def svcca_distance_keeping_fixed_dims(x: Tensor,
         y = _svd_reduction_keeping_fixed_dims_using_V(y, num)
     else:
         raise ValueError(f'Not implemented {reduce_backend=}')
-    a, b, diag = cca(x, y, backend)
+    diag = cca_diag(x, y, backend)
     # div = min(x.size(1), y.size(1))
     # return 1 - diag.sum() / div
     # return 1 - diag.sum() / div
@@ -351,7 +438,7 @@ def _pwcca_distance2(x: Tensor,
     assert alpha_tilde.size() == torch.Size([C])
     alpha = alpha_tilde / alpha_tilde.sum()
     assert alpha_tilde.size() == torch.Size([C])
-    return 1.0 - (alpha @ diag)
+    return 1.0 - (alpha * diag).sum()
 
 
 def pwcca_distance_choose_best_layer_matrix(x: Tensor,
@@ -418,7 +505,7 @@ def pwcca_distance_choose_best_layer_matrix(x: Tensor,
     assert alpha_tilde.size() == torch.Size([C])
     alpha = alpha_tilde / alpha_tilde.sum()
     assert alpha_tilde.size() == torch.Size([C])
-    return 1.0 - (alpha @ diag)
+    return 1.0 - (alpha * diag).sum()
 
 
 def _pwcca_distance_from_original_svcca(L1: Tensor,
@@ -485,15 +572,13 @@ def _pwcca_distance_from_original_svcca(L1: Tensor,
 
 
 def _debiased_dot_product_similarity(z: Tensor,
-                                     sum_row_x: Tensor,
-                                     sum_row_y: Tensor,
-                                     sq_norm_x: Tensor,
-                                     sq_norm_y: Tensor,
+                                     cross: Tensor,
+                                     corr: Tensor,
                                      size: int
                                      ) -> Tensor:
-    return (z
-            - size / (size - 2) * (sum_row_x @ sum_row_y)
-            + sq_norm_x * sq_norm_y / ((size - 1) * (size - 2)))
+    # cross = sum_row_x @ sum_row_y and corr = sq_norm_x * sq_norm_y / ((size - 1) * (size - 2))
+    # are shared by all the terms of CKA, so they are computed once by the caller
+    return z - size / (size - 2) * cross + corr
 
 
 def linear_cka_distance(x: Tensor,
@@ -511,28 +596,46 @@ def linear_cka_distance(x: Tensor,
 
     """
     # _check_shape_equal(x, y, 0)
+    if x.size(0) != y.size(0):
+        raise ValueError(f'x.size(0) == y.size(0) is expected, but got {x.size(0)=}, {y.size(0)=} instead.')
+    return _linear_cka_distance(x, y, reduce_bias)
+
+
+@_compile
+def _linear_cka_distance(x: Tensor,
+                         y: Tensor,
+                         reduce_bias: bool
+                         ) -> Tensor:
     x = _zero_mean(x, dim=0)
     y = _zero_mean(y, dim=0)
     # x = _matrix_normalize(x, dim=0)
     # y = _matrix_normalize(y, dim=0)
 
-    if x.size(0) != y.size(0):
-        raise ValueError(f'x.size(0) == y.size(0) is expected, but got {x.size(0)=}, {y.size(0)=} instead.')
-
-    dot_prod = (y.t() @ x).norm('fro').pow(2)
-    norm_x = (x.t() @ x).norm('fro')
-    norm_y = (y.t() @ y).norm('fro')
+    size, d_x = x.size()
+    d_y = y.size(1)
+    if size * (d_x + d_y) < d_x * d_x + d_x * d_y + d_y * d_y:
+        # wide inputs: use NxN Gram matrices, as ||Y^T X||_F^2 = <X X^T, Y Y^T>_F and ||X^T X||_F = ||X X^T||_F
+        gram_x = x @ x.t()
+        gram_y = y @ y.t()
+        dot_prod = (gram_x * gram_y).sum()
+        norm_x = gram_x.norm('fro')
+        norm_y = gram_y.norm('fro')
+    else:
+        dot_prod = (y.t() @ x).norm('fro').pow(2)
+        norm_x = (x.t() @ x).norm('fro')
+        norm_y = (y.t() @ y).norm('fro')
 
     if reduce_bias:
-        size = x.size(0)
         # (x @ x.t()).diag()
-        sum_row_x = torch.einsum('ij,ij->i', x, x)
-        sum_row_y = torch.einsum('ij,ij->i', y, y)
+        sum_row_x = x.square().sum(dim=1)
+        sum_row_y = y.square().sum(dim=1)
         sq_norm_x = sum_row_x.sum()
         sq_norm_y = sum_row_y.sum()
-        dot_prod = _debiased_dot_product_similarity(dot_prod, sum_row_x, sum_row_y, sq_norm_x, sq_norm_y, size)
-        norm_x = _debiased_dot_product_similarity(norm_x.pow_(2), sum_row_x, sum_row_y, sq_norm_x, sq_norm_y, size)
-        norm_y = _debiased_dot_product_similarity(norm_y.pow_(2), sum_row_x, sum_row_y, sq_norm_x, sq_norm_y, size)
+        cross = sum_row_x @ sum_row_y
+        corr = sq_norm_x * sq_norm_y / ((size - 1) * (size - 2))
+        dot_prod = _debiased_dot_product_similarity(dot_prod, cross, corr, size)
+        norm_x = _debiased_dot_product_similarity(norm_x.pow_(2), cross, corr, size)
+        norm_y = _debiased_dot_product_similarity(norm_y.pow_(2), cross, corr, size)
     return 1 - dot_prod / (norm_x * norm_y)
 
 
@@ -579,9 +682,13 @@ class SimilarityHook(object):
         cca_distance: the method to compute CCA and CKA distance. By default, PWCCA is used.
         'pwcca', 'svcca', 'lincka' or partial functions such as `partial(pwcca_distance, backend='qr')` are expected.
         force_cpu: Force computation on CPUs. In some cases, CCA computation is faster on CPUs than on GPUs.
+        Otherwise, hooked tensors are kept on the device of the module, unless the device is running out of memory, in
+        which case they are moved to CPU. Note that `hooked_tensors` is then a tensor on the device of the module.
     """
 
     _supported_dim = (2, 4)
+    # share of the device memory kept free when hooked tensors are stored on the device
+    _device_memory_margin = 0.1
     # _default_backends = {'pwcca': partial(pwcca_distance, backend='svd'),
     #                      'svcca': partial(svcca_distance, accept_rate=0.99, backend='svd'),
     #                      'lincka': partial(linear_cka_distance, reduce_bias=False),
@@ -619,7 +726,10 @@ class SimilarityHook(object):
             torch.set_num_threads(cpu_count())
 
         self.device = None
+        # outputs of each forward, concatenated lazily in hooked_tensors
+        self._chunks: List[Tensor] = []
         self._hooked_tensors = None
+        self._copy_event = None
         self._register_hook()
 
     def _register_hook(self
@@ -631,28 +741,66 @@ class SimilarityHook(object):
                                    f'but got {output.dim()} instead.')
 
             self.device = output.device
-            # store intermediate tensors on CPU to avoid possible CUDA OOM
-            output = output.cpu()
+            output = output.detach()
+            if output.is_cuda and (self.force_cpu or self._is_device_memory_low(output)):
+                # asynchronous copy to CPU, synchronized when hooked_tensors is read
+                output = output.to('cpu', non_blocking=True)
+                self._copy_event = torch.cuda.Event()
+                self._copy_event.record()
 
-            if self._hooked_tensors is None:
-                self._hooked_tensors = output
-            else:
-                self._hooked_tensors = torch.cat([self._hooked_tensors, output], dim=0).contiguous()
+            # appending is O(1), concatenating every call would copy all the stored tensors each time
+            self._chunks.append(output)
+            self._hooked_tensors = None
 
         self.module.register_forward_hook(hook)
 
+    @classmethod
+    def _is_device_memory_low(cls,
+                              output: Tensor
+                              ) -> bool:
+        # OOM guard: keep the output on the device only if what is left afterwards still covers the peak the model
+        # needed so far above the currently allocated memory (activations and workspaces of a forward and backward),
+        # plus a share of the device for fragmentation
+        device = output.device
+        free, total = torch.cuda.mem_get_info(device)
+        allocated = torch.cuda.memory_allocated(device)
+        free += torch.cuda.memory_reserved(device) - allocated
+        needed = torch.cuda.max_memory_allocated(device) - allocated + cls._device_memory_margin * total
+        return free - output.numel() * output.element_size() < needed
+
     def clear(self
               ) -> None:
         """ Clear stored tensors
         """
 
+        self._chunks = []
         self._hooked_tensors = None
+        self._copy_event = None
 
     @property
     def hooked_tensors(self
                        ) -> Tensor:
-        if self._hooked_tensors is None:
+        """ Outputs of the module concatenated along the 0th dimension. They are on the device of the module unless
+        `force_cpu` is set or the device was running out of memory, in which case they are on CPU.
+        """
+
+        if len(self._chunks) == 0:
             raise RuntimeError('Run model in advance')
+        if self._hooked_tensors is None:
+            if self._copy_event is not None:
+                self._copy_event.synchronize()
+                self._copy_event = None
+            if len({chunk.device for chunk in self._chunks}) > 1:
+                # some outputs were moved to CPU by the OOM guard
+                self._chunks = [chunk.cpu() for chunk in self._chunks]
+            try:
+                self._hooked_tensors = torch.cat(self._chunks, dim=0) if len(self._chunks) > 1 else self._chunks[0]
+            except RuntimeError as e:
+                if 'out of memory' not in str(e):
+                    raise
+                # OOM guard: concatenating on the device needs twice the memory of the stored outputs
+                self._hooked_tensors = torch.cat([chunk.cpu() for chunk in self._chunks], dim=0)
+            self._chunks = [self._hooked_tensors]
         return self._hooked_tensors
 
     @staticmethod
@@ -676,6 +824,8 @@ class SimilarityHook(object):
             cca_distance: the method to compute CCA and CKA distance. By default, PWCCA is used.
             'pwcca', 'svcca', 'lincka' or partial functions such as `partial(pwcca_distance, backend='qr')` are expected.
             force_cpu: Force computation on CPUs. In some cases, CCA computation is faster on CPUs than on GPUs.
+            Otherwise, hooked tensors are kept on the device of the module, unless the device is running out of
+            memory, in which case they are moved to CPU.
 
         Returns: List of hooks
 
@@ -729,10 +879,10 @@ class SimilarityHook(object):
         # print(f'{self_tensor.size()=}')
         # print(f'{other_tensor.size()=}')
         # st()
-        if not self.force_cpu:
-            # hooked_tensors is CPU tensor, so need to device
-            self_tensor = self_tensor.to(self.device)
-            other_tensor = other_tensor.to(self.device)
+        # other may have been hooked with a different force_cpu, or moved to CPU by the OOM guard
+        device = torch.device('cpu') if self.force_cpu else self_tensor.device
+        self_tensor = self_tensor.to(device)
+        other_tensor = other_tensor.to(device)
         if self_tensor.size(0) != other_tensor.size(0):
             raise RuntimeError('0th dimension of hooked tensors are different')
         if self_tensor.dim() != other_tensor.dim():
@@ -837,7 +987,7 @@ class SimilarityHook(object):
                          f'got, {h=} and {w=}.'
 
         if (downsample_size, downsample_size) == (h, w):
-            return input.flatten(2).permute(2, 0, 1)
+            return input.flatten(2).permute(2, 0, 1).contiguous()
 
         if (downsample_size, downsample_size) > (h, w):
             raise RuntimeError(f'downsample_size is expected to be smaller than h or w, but got {h=}, {w=}.')
@@ -854,21 +1004,30 @@ class SimilarityHook(object):
             # https://github.com/google/svcca/blob/master/dft_ccas.py
             if input.size(2) != input.size(3):
                 raise RuntimeError('width and height of input needs to be equal')
-            h = input.size(2)
-            input_fft = _rfft(input, 2, normalized=True, onesided=False)
-            freqs = fftfreq(h, 1 / h, device=input.device)
-            idx = (freqs >= -downsample_size / 2) & (freqs < downsample_size / 2)
-            # BxCxHxWx2 -> BxCxhxwx2
-            input_fft = input_fft[..., idx, :][..., idx, :, :]
-            input = _irfft(input_fft, 2, normalized=True, onesided=False)
+            input_fft = torch.fft.fft2(input, norm='ortho')
+            # BxCxHxW -> BxCxhxw, kept complex until the inverse transform
+            input_fft = _crop_spectrum(_crop_spectrum(input_fft, downsample_size, dim=-2), downsample_size, dim=-1)
+            input = torch.fft.ifft2(input_fft, norm='ortho').real
         # - [B, C, H, W] -> [HW, B, C]
         # [B, C, H, W] -> [B, C, HW]
         input = input.flatten(start_dim=2, end_dim=-1)
-        # [B, C, HW]  -> [HW, B, C]
-        input = input.permute(2, 0, 1)
+        # [B, C, HW]  -> [HW, B, C], contiguous so that each [B, C] matrix is a dense slab for the later matmuls
+        input = input.permute(2, 0, 1).contiguous()
         return input
 
 
+def _crop_spectrum(input_fft: Tensor,
+                   downsample_size: int,
+                   dim: int
+                   ) -> Tensor:
+    # keep the frequencies in [-downsample_size / 2, downsample_size / 2) of an unshifted spectrum, i.e.,
+    # its first ceil(downsample_size / 2) and last floor(downsample_size / 2) bins, already in the order of fft
+    n = input_fft.size(dim)
+    return torch.cat([input_fft.narrow(dim, 0, (downsample_size + 1) // 2),
+                      input_fft.narrow(dim, n - downsample_size // 2, downsample_size // 2)],
+                     dim=dim)
+
+
 def _subsample_matrix_in_effective_num_data_points(hook: SimilarityHook,
                                                    data_matrix: Tensor,
                                                    subsample_effective_num_data_method: str,
@@ -964,13 +1123,50 @@ def _subsample_matrix_in_effective_num_data_points(hook: SimilarityHook,
 DistanceHook = SimilarityHook
 
 
+# - distance functions without data-dependent control flow, which can be batched over matrices with torch.vmap
+_VMAP_SAFE_DISTANCES = (linear_cka_distance, orthogonal_procrustes_distance)
+
+
+def _is_vmap_safe(cca_function: Callable[[Tensor, Tensor], Tensor]
+                  ) -> bool:
+    if isinstance(cca_function, partial):
+        cca_function = cca_function.func
+    return cca_function in _VMAP_SAFE_DISTANCES
+
+
+def _distances_per_matrix(cca_function: Callable[[Tensor, Tensor], Tensor],
+                          self_tensor: Tensor,
+                          other_tensor: Tensor
+                          ) -> Tensor:
+    """
+    Compute the distance between each pair of matrices of [M, N, D1] and [M, N, D2], returning a tensor of [M].
+
+    Note:
+        - for the distances in _VMAP_SAFE_DISTANCES, the M distances are computed with torch.vmap, so that e.g. the
+        SVDs are batched. Every intermediate is materialized for all the matrices of a call, e.g. M NxN Gram matrices
+        for linear CKA, so the matrices are batched by chunks of VMAP_CHUNK_SIZE.
+        - other distance functions may have data-dependent control flow (e.g. svcca's truncation or pwcca choosing the
+        layer matrix), which can't be vmapped, so they are computed in a loop over M.
+        - distances are returned as a tensor, so callers should call .item() once on the reduced value rather than on
+        each distance, which would synchronize with the device M times.
+    """
+    if hasattr(torch, 'vmap') and _is_vmap_safe(cca_function):
+        vmapped = torch.vmap(cca_function)
+        return torch.cat([vmapped(self_chunk, other_chunk)
+                          for self_chunk, other_chunk in zip(self_tensor.split(VMAP_CHUNK_SIZE),
+                                                             other_tensor.split(VMAP_CHUNK_SIZE))
+                          ]
+                         )
+    return torch.stack([cca_function(s, o)
+                        for s, o in zip(self_tensor.unbind(), other_tensor.unbind())
+                        ]
+                       )
+
+
 def original_computation_of_distance_from_Ryuichiro_Hataya(self: DistanceHook,
                                                            self_tensor: Tensor,
                                                            other_tensor: Tensor) -> float:
-    return torch.stack([self.cca_function(s, o)
-                        for s, o in zip(self_tensor.unbind(), other_tensor.unbind())
-                        ]
-                       ).mean().item()
+    return _distances_per_matrix(self.cca_function, self_tensor, other_tensor).mean().item()
 
 
 def original_computation_of_distance_from_Ryuichiro_Hataya_as_loop(self: DistanceHook,
@@ -1001,14 +1197,16 @@ def original_computation_of_distance_from_Ryuichiro_Hataya_as_loop(self: Distanc
     other_tensor: tuple[Tensor] = other_tensor.unbind()
     assert (len(self_tensor) == M and len(other_tensor) == M)
     # - for each of the M data points, compute the distance/similarity,
-    dists_for_wrt_entire_data_points: list[float] = []
+    # kept as 0-D tensors so that the loop doesn't synchronize with the device at every iteration
+    dists_for_wrt_entire_data_points: list[Tensor] = []
     for m in range(M):
         s, o = self_tensor[m], other_tensor[m]
-        dist: float = self.cca_function(s, o)
+        dist: Tensor = self.cca_function(s, o)
         dists_for_wrt_entire_data_points.append(dist)
     # - compute dist
     # return it to [M, F, HW]
     dists_for_wrt_entire_data_points: Tensor = torch.stack(dists_for_wrt_entire_data_points)
+    # - the only synchronization, at the outermost boundary
     dist: float = dists_for_wrt_entire_data_points.mean().item()
     return dist
 
@@ -1027,10 +1225,7 @@ def downsampling_choice_logic_original_anatome(self: DistanceHook, self_tensor:
         self_tensor = self._downsample_4d(self_tensor, size, downsample_method)
         other_tensor = self._downsample_4d(other_tensor, size, downsample_method)
     # - compute distance = 1.0 - sim
-    return torch.stack([self.cca_function(s, o)
-                        for s, o in zip(self_tensor.unbind(), other_tensor.unbind())
-                        ]
-                       ).mean().item()
+    return _distances_per_matrix(self.cca_function, self_tensor, other_tensor).mean().item()
 
 
 def distance_cnn_original_anatome(self: DistanceHook, size: Optional[int],
@@ -1061,11 +1256,8 @@ def distance_cnn_original_anatome(self: DistanceHook, size: Optional[int],
         self_tensor = self._downsample_4d(self_tensor, size, downsample_method)
         other_tensor = self._downsample_4d(other_tensor, size, downsample_method)
     # - compute distance = 1.0 - sim
-    # loop through each of the M or size^2 data matrices of size [N_eff, D_eff]
-    return torch.stack([self.cca_function(s, o)
-                        for s, o in zip(self_tensor.unbind(), other_tensor.unbind())
-                        ]
-                       ).mean().item()
+    # each of the M or size^2 data matrices of size [N_eff, D_eff]
+    return _distances_per_matrix(self.cca_function, self_tensor, other_tensor).mean().item()
 
 
 def _compute_cca_traditional_equation(acts1, acts2,
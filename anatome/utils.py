@@ -1,5 +1,6 @@
 import time
 from collections import OrderedDict
+from functools import wraps
 from importlib.metadata import version
 from pprint import pprint
 from typing import Callable, Optional, Tuple, Union
@@ -8,6 +9,7 @@ import torch
 from torch import Tensor, nn
 
 AUTO_CAST = False
+COMPILE = False
 HAS_FFT_MODULE = (version("torch") >= "1.7.0")
 if HAS_FFT_MODULE:
     import torch.fft
@@ -20,6 +22,29 @@ def use_auto_cast() -> None:
     AUTO_CAST = True
 
 
+def use_compile() -> None:
+    """ Enable torch.compile for the small tensor kernels of distances, e.g., linear CKA. Needs torch>=2.0.
+    """
+    global COMPILE
+    COMPILE = True
+
+
+def _compile(func: Callable) -> Callable:
+    # compile func lazily at the first call after use_compile(), otherwise run it eagerly
+    compiled = None
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal compiled
+        if not COMPILE or not hasattr(torch, "compile"):
+            return func(*args, **kwargs)
+        if compiled is None:
+            compiled = torch.compile(func, dynamic=True)
+        return compiled(*args, **kwargs)
+
+    return wrapper
+
+
 def _svd(input: torch.Tensor
          ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     # torch.svd style
@@ -28,6 +53,16 @@ def _svd(input: torch.Tensor
     return U, S, V
 
 
+def _solve_triangular(r: torch.Tensor,
+                      input: torch.Tensor
+                      ) -> torch.Tensor:
+    # r.inverse() @ input for upper-triangular r, without forming the inverse
+    if hasattr(torch.linalg, "solve_triangular"):
+        return torch.linalg.solve_triangular(r, input, upper=True)
+    # torch<1.11
+    return torch.triangular_solve(input, r, upper=True).solution
+
+
 @torch.no_grad()
 def _evaluate(model: nn.Module,
               data: Tuple[Tensor, Tensor],
@@ -39,6 +74,19 @@ def _evaluate(model: nn.Module,
         return criterion(model(input), target).item()
 
 
+@torch.no_grad()
+def _evaluate_batch(model: nn.Module,
+                    data: Tuple[Tensor, Tensor],
+                    criterion: Callable[[Tensor, Tensor], Tensor]
+                    ) -> Tensor:
+    # evaluate model with K stacked copies of data points, i.e., input of KxBx..., in a single forward pass
+    # returns a tensor of K criterion values
+    with torch.cuda.amp.autocast(AUTO_CAST):
+        input, target = data
+        output = model(input.flatten(0, 1))
+        return torch.stack([criterion(o, target) for o in output.split(input.size(1))])
+
+
 def _normalize(input: Tensor,
                mean: Tensor,
                std: Tensor
@@ -65,17 +113,16 @@ def fft_shift(input: torch.Tensor,
     """ PyTorch version of np.fftshift
 
     Args:
-        input: rFFTed Tensor of size [Bx]CxHxWx2
-        dims:
+        input: FFTed Tensor of size [Bx]CxHxW (complex) or [Bx]CxHxWx2 (real view)
+        dims: dimensions to be shifted. By default, H and W.
 
     Returns: shifted tensor
 
     """
 
     if dims is None:
-        dims = [i for i in range(1 if input.dim() == 4 else 2, input.dim() - 1)]  # H, W
-    shift = [input.size(dim) // 2 for dim in dims]
-    return torch.roll(input, shift, dims)
+        dims = _default_shift_dims(input)
+    return torch.fft.fftshift(input, dim=dims)
 
 
 def ifft_shift(input: torch.Tensor,
@@ -84,17 +131,22 @@ def ifft_shift(input: torch.Tensor,
     """ PyTorch version of np.ifftshift
 
     Args:
-        input: rFFTed Tensor of size [Bx]CxHxWx2
-        dims:
+        input: FFTed Tensor of size [Bx]CxHxW (complex) or [Bx]CxHxWx2 (real view)
+        dims: dimensions to be shifted. By default, H and W.
 
     Returns: shifted tensor
 
     """
 
     if dims is None:
-        dims = [i for i in range(input.dim() - 2, 0 if input.dim() == 4 else 1, -1)]  # H, W
-    shift = [-input.size(dim) // 2 for dim in dims]
-    return torch.roll(input, shift, dims)
+        dims = _default_shift_dims(input)
+    return torch.fft.ifftshift(input, dim=dims)
+
+
+def _default_shift_dims(input: torch.Tensor
+                        ) -> Tuple[int, int]:
+    # H and W, skipping the last dimension of the real view
+    return (-2, -1) if torch.is_complex(input) else (-3, -2)
 
 
 def fftfreq(window_length: int,
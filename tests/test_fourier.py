@@ -1,3 +1,4 @@
+import pytest
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -15,3 +16,29 @@ def test_landscape():
             torch.randint(2, (10,)))
     fourier.fourier_map(model, data, F.cross_entropy, 4)
     fourier.fourier_map(model, data, F.cross_entropy, 4, (2, 2))
+
+
+def _fourier_noise_by_ifft2(idx, images, norm, size=None):
+    # reference: iFFT of the pair of (1+1j) deltas, shifted by rolling -ceil(n/2) as the former ifft_shift did
+    h, w = size or images.shape[2:]
+    noise = torch.zeros(1, h, w, dtype=torch.complex128)
+    noise[:, idx[0], idx[1]] = 1 + 1j
+    noise[:, h - 1 - idx[0], w - 1 - idx[1]] = 1 + 1j
+    noise = torch.roll(noise, (-h // 2, -w // 2), (1, 2))
+    recon = torch.fft.ifft2(noise, norm="ortho").real.unsqueeze(0)
+    recon = recon / recon.norm() * norm
+    if size is not None:
+        recon = F.interpolate(recon, images.shape[2:])
+    return recon
+
+
+@pytest.mark.parametrize("hw,size", [((8, 8), None), ((7, 7), None), ((7, 10), None), ((16, 16), (3, 3)),
+                                     ((16, 16), (4, 5))])
+def test_fourier_noise_batch(hw, size):
+    images = torch.rand(2, 3, *hw, dtype=torch.float64)
+    h, w = size or hw
+    idx = torch.triu_indices(h, w).t()
+    recon, scale = fourier._fourier_noise_batch(idx, images, 4, size)
+    for i, (recon_i, scale_i) in enumerate(zip(recon, scale)):
+        expected = _fourier_noise_by_ifft2(idx[i].tolist(), images, 4, size)[0]
+        assert torch.allclose(recon_i * scale_i, expected, atol=1e-10)
@@ -0,0 +1,117 @@
+from functools import partial
+
+import pytest
+import torch
+
+from anatome import similarity
+from anatome.utils import fftfreq
+
+
+def test_opd_backward():
+    x = torch.randn(100, 20, requires_grad=True)
+    y = torch.randn(100, 10)
+    similarity.orthogonal_procrustes_distance(x, y).backward()
+    assert x.grad is not None
+
+
+@pytest.mark.parametrize("cca_function", [partial(similarity.linear_cka_distance, reduce_bias=False),
+                                          partial(similarity.linear_cka_distance, reduce_bias=True),
+                                          similarity.orthogonal_procrustes_distance])
+def test_distances_per_matrix(cca_function, monkeypatch):
+    # 3 chunks, the last one smaller
+    monkeypatch.setattr(similarity, 'VMAP_CHUNK_SIZE', 2)
+    x = torch.randn(5, 50, 8, dtype=torch.float64)
+    y = torch.randn(5, 50, 6, dtype=torch.float64)
+    assert similarity._is_vmap_safe(cca_function)
+    expected = torch.stack([cca_function(x_i, y_i) for x_i, y_i in zip(x, y)])
+    assert torch.allclose(similarity._distances_per_matrix(cca_function, x, y), expected)
+
+
+def _matrix_with_spectrum(n, d, rank):
+    u = torch.linalg.qr(torch.randn(n, d, dtype=torch.float64))[0]
+    v = torch.linalg.qr(torch.randn(d, d, dtype=torch.float64))[0]
+    spectrum = torch.cat([torch.logspace(2, 0, rank, dtype=torch.float64),
+                          torch.full((d - rank,), 1e-4, dtype=torch.float64)])
+    return (u * spectrum) @ v.t()
+
+
+def test_svd_reduction_lowrank(monkeypatch):
+    x = _matrix_with_spectrum(400, 200, 20)
+    y = _matrix_with_spectrum(400, 150, 30)
+    full = [similarity._svd_reduction(input, 0.99) for input in (x, y)]
+    distance = similarity.svcca_distance(x, y, 0.99, 'svd')
+    monkeypatch.setattr(similarity, 'LOWRANK_SVD', True)
+    lowrank = [similarity._svd_reduction_lowrank(input, 0.99, similarity.LOWRANK_SVD_Q) for input in (x, y)]
+    assert [r.size(1) for r in lowrank] == [r.size(1) for r in full]
+    assert torch.allclose(distance, similarity.svcca_distance(x, y, 0.99, 'svd'))
+
+
+def test_svd_reduction_lowrank_fallback(monkeypatch):
+    # power-law spectrum: the bounds of the randomized SVD don't agree, so the full SVD is computed on top of it
+    u = torch.linalg.qr(torch.randn(1000, 256, dtype=torch.float64))[0]
+    v = torch.linalg.qr(torch.randn(256, 256, dtype=torch.float64))[0]
+    input = (u / torch.arange(1, 257, dtype=torch.float64)) @ v.t()
+    assert similarity._svd_reduction_lowrank(input, 0.99, similarity.LOWRANK_SVD_Q) is None
+    full = similarity._svd_reduction(input, 0.99)
+    monkeypatch.setattr(similarity, 'LOWRANK_SVD', True)
+    assert torch.allclose(similarity._svd_reduction(input, 0.99), full)
+
+
+@pytest.mark.parametrize("h,size", [(h, size) for h in range(2, 13) for size in range(1, h)])
+def test_downsample_4d_dft(h, size):
+    input = torch.randn(2, 3, h, h, dtype=torch.float64)
+    # reference: mask of the frequencies in [-size / 2, size / 2)
+    freqs = fftfreq(h, 1 / h)
+    mask = (freqs >= -size / 2) & (freqs < size / 2)
+    expected = torch.fft.ifft2(torch.fft.fft2(input, norm='ortho')[..., mask, :][..., mask], norm='ortho').real
+    expected = expected.flatten(2).permute(2, 0, 1)
+    assert torch.allclose(similarity.SimilarityHook._downsample_4d(input, size, 'dft'), expected)
+
+
+def _linear_cka_distance_by_feature_gram(x, y, reduce_bias):
+    # reference: the DxD branch of _linear_cka_distance, whatever the shapes are
+    x = x - x.mean(dim=0)
+    y = y - y.mean(dim=0)
+    size = x.size(0)
+    dot_prod = (y.t() @ x).norm('fro').pow(2)
+    norm_x = (x.t() @ x).norm('fro')
+    norm_y = (y.t() @ y).norm('fro')
+    if reduce_bias:
+        sum_row_x = x.square().sum(dim=1)
+        sum_row_y = y.square().sum(dim=1)
+        cross = sum_row_x @ sum_row_y
+        corr = sum_row_x.sum() * sum_row_y.sum() / ((size - 1) * (size - 2))
+        dot_prod = similarity._debiased_dot_product_similarity(dot_prod, cross, corr, size)
+        norm_x = similarity._debiased_dot_product_similarity(norm_x.pow(2), cross, corr, size)
+        norm_y = similarity._debiased_dot_product_similarity(norm_y.pow(2), cross, corr, size)
+    return 1 - dot_prod / (norm_x * norm_y)
+
+
+@pytest.mark.parametrize("reduce_bias", [False, True])
+def test_linear_cka_distance_wide(reduce_bias):
+    # N(D1 + D2) < D1^2 + D1 D2 + D2^2, so linear_cka_distance uses the NxN Gram matrices
+    x = torch.randn(20, 100, dtype=torch.float64)
+    y = torch.randn(20, 80, dtype=torch.float64)
+    assert torch.allclose(similarity.linear_cka_distance(x, y, reduce_bias),
+                          _linear_cka_distance_by_feature_gram(x, y, reduce_bias))
+
+
+@pytest.mark.parametrize("backend", ['svd', 'qr'])
+def test_cca_diag(backend):
+    x = torch.randn(100, 20, dtype=torch.float64)
+    y = torch.randn(100, 10, dtype=torch.float64)
+    assert torch.allclose(similarity.cca_diag(x, y, backend), similarity.cca(x, y, backend)[2])
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs CUDA')
+@pytest.mark.parametrize("force_cpu", [False, True])
+def test_hooked_tensors_device(force_cpu):
+    model = torch.nn.Sequential(torch.nn.Linear(10, 10), torch.nn.Linear(10, 5)).cuda()
+    hook1 = similarity.SimilarityHook(model, '0', 'lincka', force_cpu=force_cpu)
+    hook2 = similarity.SimilarityHook(model, '1', 'lincka')
+    with torch.no_grad():
+        for _ in range(2):
+            model(torch.randn(50, 10, device='cuda'))
+    assert hook1.hooked_tensors.is_cuda != force_cpu
+    assert hook2.hooked_tensors.is_cuda
+    hook1.distance(hook2)
@@ -1,3 +1,5 @@
+import numpy as np
+import pytest
 import torch
 
 from anatome import utils
@@ -11,12 +13,17 @@ def test_normalize_denormalize():
                                 mean, std)
     assert torch.allclose(input, output, atol=1e-4)
 
-#
-# def test_fft_shift():
-#     input = torch.randn(4, 3, 8, 8)
-#     fft = utils.fft_shift(input.rfft(2, normalized=True, onesided=False))
-#     ifft = utils.ifft_shift(fft).irfft(2, normalized=True, onesided=False)
-#     assert torch.allclose(input, ifft, atol=1e-4)
+
+@pytest.mark.parametrize("size", [8, 7])
+def test_fft_shift(size):
+    input = torch.randn(4, 3, size, size)
+    fft = utils.fft_shift(torch.fft.fft2(input, norm="ortho"))
+    assert torch.allclose(fft, torch.as_tensor(np.fft.fftshift(np.fft.fft2(input.numpy(), norm="ortho"), axes=(-2, -1))),
+                          atol=1e-4)
+    ifft = torch.fft.ifft2(utils.ifft_shift(fft), norm="ortho").real
+    assert torch.allclose(input, ifft, atol=1e-4)
+    real_view = torch.view_as_real(torch.fft.fft2(input))
+    assert torch.equal(utils.fft_shift(real_view), torch.view_as_real(utils.fft_shift(torch.fft.fft2(input))))
 
 #
 # @pytest.mark.skipif(not utils.HAS_FFT_MODULE and hasattr(torch, "rfft"), reason="")